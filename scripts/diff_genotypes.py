@@ -1,13 +1,29 @@
 #!/usr/bin/env python3
 """
 Diff two genotype files, ignoring gs/baf/lrr columns.
+
+Requires pandas and numpy (installed by jupyter.sh).
 """
 
 from __future__ import annotations
 
 import argparse
+import csv
+import heapq
 from pathlib import Path
-from typing import Dict, Tuple
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+GENOTYPE_COLUMNS = ["rsid", "chrom", "pos", "genotype"]
+GENOTYPE_DTYPES = {"rsid": str, "chrom": "category", "pos": str, "genotype": "category"}
+
+# Read buffer for the --sorted streaming reader.
+INPUT_BUFFER_SIZE = 1 << 20
+
+# (chrom, pos, genotype) as printed for one side of a difference.
+Fields = Tuple[object, object, object]
 
 
 def parse_args() -> argparse.Namespace:
@@ -22,70 +38,257 @@ def parse_args() -> argparse.Namespace:
         default=20,
         help="Maximum number of differing rows to print (default: 20)",
     )
+    parser.add_argument(
+        "--sorted",
+        action="store_true",
+        help="Both files are sorted by rsid: stream a merge join instead of "
+        "loading them into memory",
+    )
     return parser.parse_args()
 
 
-def load_genotypes(path: Path) -> Dict[str, Tuple[str, str, str]]:
-    genotypes: Dict[str, Tuple[str, str, str]] = {}
-    with path.open() as handle:
+def load_genotypes(path: Path) -> pd.DataFrame:
+    try:
+        genotypes = pd.read_csv(
+            path,
+            sep="\t",
+            header=None,
+            names=GENOTYPE_COLUMNS,
+            usecols=range(len(GENOTYPE_COLUMNS)),
+            dtype=GENOTYPE_DTYPES,
+            # Take every field verbatim: no NA markers, quoting or inline comments.
+            keep_default_na=False,
+            na_filter=False,
+            quoting=csv.QUOTE_NONE,
+            engine="c",
+        )
+    except (pd.errors.EmptyDataError, pd.errors.ParserError):
+        # Raised when no line has four columns (e.g. only comments or short
+        # rows), so there is no row to keep.
+        return pd.DataFrame(
+            {name: pd.Series(dtype=dtype) for name, dtype in GENOTYPE_DTYPES.items()}
+        )
+    # Comment lines and rows with fewer than four columns (missing fields read
+    # as "") are skipped. Duplicate rsids are resolved in diff_loaded.
+    comment = genotypes["rsid"].str.startswith("#").to_numpy(dtype=bool)
+    return genotypes[~comment & (genotypes["genotype"] != "").to_numpy()]
+
+
+def last_rows(codes: np.ndarray, size: int) -> np.ndarray:
+    """Row of each rsid code's last occurrence (later duplicates win); -1 if absent."""
+    rows = np.full(size, -1, dtype=np.int64)
+    last = ~pd.Index(codes).duplicated(keep="last")
+    rows[codes[last]] = np.flatnonzero(last)
+    return rows
+
+
+def category_codes(base: pd.Series, cand: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """Re-code two categorical columns against their merged vocabulary.
+
+    Values are matched by exact string, so equal codes mean equal fields.
+    """
+    base_cats = base.cat.categories
+    lut = base_cats.get_indexer(cand.cat.categories)
+    new = lut < 0
+    lut[new] = len(base_cats) + np.arange(np.count_nonzero(new))
+    return base.cat.codes.to_numpy(), lut[cand.cat.codes.to_numpy()]
+
+
+def iter_sorted_genotypes(path: Path) -> Iterator[Tuple[bytes, bytes, bytes, bytes]]:
+    """Stream (rsid, chrom, pos, genotype) rows from a file sorted by rsid.
+
+    Fields stay undecoded bytes; only printed values are decoded. Rows are
+    accepted exactly as in load_genotypes: comment lines and rows without a
+    genotype are skipped, and every field is kept verbatim.
+    """
+    previous: Optional[Tuple[bytes, bytes, bytes, bytes]] = None
+    with open(path, "rb", buffering=INPUT_BUFFER_SIZE) as handle:
         for raw in handle:
-            if raw.startswith("#"):
+            if raw.startswith(b"#"):
                 continue
-            parts = raw.strip().split("\t")
-            if len(parts) < 4:
+            # Only the first four columns are needed; don't split the rest.
+            rsid, _, rest = raw.partition(b"\t")
+            chrom, _, rest = rest.partition(b"\t")
+            pos, sep, rest = rest.partition(b"\t")
+            genotype = rest.partition(b"\t")[0].rstrip(b"\r\n")
+            if not sep or not genotype:
                 continue
-            rsid, chrom, pos, genotype = parts[:4]
-            genotypes[rsid] = (chrom, pos, genotype)
-    return genotypes
+            row = (rsid, chrom, pos, genotype)
+            if previous is not None:
+                if row[0] < previous[0]:
+                    raise SystemExit(
+                        f"{path} is not sorted by rsid at {row[0].decode()}"
+                    )
+                # Later duplicates win, as in diff_loaded.
+                if row[0] != previous[0]:
+                    yield previous
+            previous = row
+    if previous is not None:
+        yield previous
 
 
-def main() -> None:
-    args = parse_args()
-    if not args.baseline.exists():
-        raise SystemExit(f"Missing baseline file: {args.baseline}")
-    if not args.candidate.exists():
-        raise SystemExit(f"Missing candidate file: {args.candidate}")
+def print_report(
+    *,
+    base_count: int,
+    cand_count: int,
+    missing_count: int,
+    added_count: int,
+    diff_count: int,
+    diffs: Sequence[Tuple[str, Fields, Fields]],
+    missing: Sequence[str],
+    added: Sequence[str],
+    max_diffs: int,
+) -> None:
+    """Print the summary; ``diffs``/``missing``/``added`` hold the printed samples."""
+    print(f"Baseline rows: {base_count:,}")
+    print(f"Candidate rows: {cand_count:,}")
+    print(f"Missing in candidate: {missing_count:,}")
+    print(f"Not present in baseline: {added_count:,}")
+    print(f"Genotype/position differences: {diff_count:,}")
 
-    base = load_genotypes(args.baseline)
-    cand = load_genotypes(args.candidate)
+    for rsid, b, c in diffs[:max_diffs]:
+        print(
+            f"- {rsid}: baseline {b[0]}:{b[1]} {b[2]} vs candidate {c[0]}:{c[1]} {c[2]}"
+        )
+
+    if diff_count > max_diffs:
+        print(f"... {diff_count - max_diffs} more differences omitted")
+
+    if missing_count:
+        print("Sample missing rsids:", ", ".join(missing[:max_diffs]))
+    if added_count:
+        print("Sample new rsids:", ", ".join(added[:max_diffs]))
+
+
+def diff_loaded(baseline: Path, candidate: Path, max_diffs: int) -> None:
+    base = load_genotypes(baseline)
+    cand = load_genotypes(candidate)
+
+    # Hash the rsid strings of both files once; duplicates, membership and the
+    # join are then integer array operations on the codes. Only the printed
+    # samples are ordered.
+    codes, rsids = pd.factorize(
+        pd.concat([base["rsid"], cand["rsid"]], ignore_index=True)
+    )
+    names = rsids.to_numpy()
+    base_rows = last_rows(codes[: len(base)], len(names))
+    cand_rows = last_rows(codes[len(base) :], len(names))
+    in_base = base_rows >= 0
+    in_cand = cand_rows >= 0
+    shared = np.flatnonzero(in_base & in_cand)
+    base_idx = base_rows[shared]
+    cand_idx = cand_rows[shared]
 
-    missing = sorted(set(base) - set(cand))
-    added = sorted(set(cand) - set(base))
+    # Chromosomes and genotypes compare as codes; positions are mostly
+    # distinct, so their strings are compared directly.
+    chrom_b, chrom_c = category_codes(base["chrom"], cand["chrom"])
+    gt_b, gt_c = category_codes(base["genotype"], cand["genotype"])
+    pos_b = base["pos"].to_numpy()
+    pos_c = cand["pos"].to_numpy()
+    differs = (
+        (chrom_b[base_idx] != chrom_c[cand_idx])
+        | (gt_b[base_idx] != gt_c[cand_idx])
+        | (pos_b[base_idx] != pos_c[cand_idx])
+    )
+    diff_base = base_idx[differs]
+    diff_cand = cand_idx[differs]
+    diff_names = names[shared[differs]]
 
     diffs = []
-    for rsid in sorted(set(base) & set(cand)):
-        b_chrom, b_pos, b_gt = base[rsid]
-        c_chrom, c_pos, c_gt = cand[rsid]
-        if (b_chrom, b_pos, b_gt) != (c_chrom, c_pos, c_gt):
-            diffs.append(
-                {
-                    "rsid": rsid,
-                    "baseline": (b_chrom, b_pos, b_gt),
-                    "candidate": (c_chrom, c_pos, c_gt),
-                }
+    for i in heapq.nsmallest(
+        max_diffs, range(len(diff_names)), key=diff_names.__getitem__
+    ):
+        b = base.iloc[diff_base[i]]
+        c = cand.iloc[diff_cand[i]]
+        diffs.append(
+            (
+                diff_names[i],
+                (b["chrom"], b["pos"], b["genotype"]),
+                (c["chrom"], c["pos"], c["genotype"]),
             )
+        )
 
-    print(f"Baseline rows: {len(base):,}")
-    print(f"Candidate rows: {len(cand):,}")
-    print(f"Missing in candidate: {len(missing):,}")
-    print(f"Not present in baseline: {len(added):,}")
-    print(f"Genotype/position differences: {len(diffs):,}")
+    missing = names[in_base & ~in_cand]
+    added = names[in_cand & ~in_base]
+    print_report(
+        base_count=int(np.count_nonzero(in_base)),
+        cand_count=int(np.count_nonzero(in_cand)),
+        missing_count=len(missing),
+        added_count=len(added),
+        diff_count=len(diff_names),
+        diffs=diffs,
+        missing=heapq.nsmallest(max_diffs, missing),
+        added=heapq.nsmallest(max_diffs, added),
+        max_diffs=max_diffs,
+    )
+
+
+def diff_sorted(baseline: Path, candidate: Path, max_diffs: int) -> None:
+    """Merge join two rsid-sorted files without holding either in memory."""
+    base_rows = iter_sorted_genotypes(baseline)
+    cand_rows = iter_sorted_genotypes(candidate)
+    base_count = cand_count = 0
+    # Only counts plus the first max_diffs of each category are kept.
+    missing_count = added_count = diff_count = 0
+    missing: List[str] = []
+    added: List[str] = []
+    diffs: List[Tuple[str, Fields, Fields]] = []
+
+    b = next(base_rows, None)
+    c = next(cand_rows, None)
+    while b is not None or c is not None:
+        if c is None or (b is not None and b[0] < c[0]):
+            missing_count += 1
+            if len(missing) < max_diffs:
+                missing.append(b[0].decode())
+            base_count += 1
+            b = next(base_rows, None)
+        elif b is None or c[0] < b[0]:
+            added_count += 1
+            if len(added) < max_diffs:
+                added.append(c[0].decode())
+            cand_count += 1
+            c = next(cand_rows, None)
+        else:
+            if b[1:] != c[1:]:
+                diff_count += 1
+                if len(diffs) < max_diffs:
+                    diffs.append(
+                        (
+                            b[0].decode(),
+                            tuple(field.decode() for field in b[1:]),
+                            tuple(field.decode() for field in c[1:]),
+                        )
+                    )
+            base_count += 1
+            cand_count += 1
+            b = next(base_rows, None)
+            c = next(cand_rows, None)
+
+    print_report(
+        base_count=base_count,
+        cand_count=cand_count,
+        missing_count=missing_count,
+        added_count=added_count,
+        diff_count=diff_count,
+        diffs=diffs,
+        missing=missing,
+        added=added,
+        max_diffs=max_diffs,
+    )
 
-    for diff in diffs[: args.max_diffs]:
-        rsid = diff["rsid"]
-        b = diff["baseline"]
-        c = diff["candidate"]
-        print(
-            f"- {rsid}: baseline {b[0]}:{b[1]} {b[2]} vs candidate {c[0]}:{c[1]} {c[2]}"
-        )
 
-    if diffs and len(diffs) > args.max_diffs:
-        print(f"... {len(diffs) - args.max_diffs} more differences omitted")
+def main() -> None:
+    args = parse_args()
+    if not args.baseline.exists():
+        raise SystemExit(f"Missing baseline file: {args.baseline}")
+    if not args.candidate.exists():
+        raise SystemExit(f"Missing candidate file: {args.candidate}")
 
-    if missing:
-        print("Sample missing rsids:", ", ".join(missing[: args.max_diffs]))
-    if added:
-        print("Sample new rsids:", ", ".join(added[: args.max_diffs]))
+    if args.sorted:
+        diff_sorted(args.baseline, args.candidate, args.max_diffs)
+    else:
+        diff_loaded(args.baseline, args.candidate, args.max_diffs)
 
 
 if __name__ == "__main__":
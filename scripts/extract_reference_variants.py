@@ -6,11 +6,15 @@ Lookup rsid reference alleles for a genotype file against a GRCh38 dbSNP VCF.
 from __future__ import annotations
 
 import argparse
-import csv
+import functools
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
 from pathlib import Path
-from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Tuple
 
-import pysam
+from cyvcf2 import VCF, Variant
 
 CONTIG_MAP: Dict[str, str] = {
     "1": "NC_000001.11",
@@ -41,6 +45,38 @@ CONTIG_MAP: Dict[str, str] = {
     "MT": "NC_012920.1",
 }
 
+# Queries whose search regions are closer than this share one tabix fetch
+# (roughly one BGZF block of dbSNP records); farther apart a fresh seek is
+# cheaper than decoding the records in between. --mode auto also reads a
+# contig sequentially once its queries are this close on average, as the
+# fetches would then decode most of it anyway.
+FETCH_MERGE_GAP = 1_000
+
+OUTPUT_FIELDS: Tuple[str, ...] = (
+    "query_rsid",
+    "query_chrom",
+    "query_pos",
+    "ref_contig",
+    "ref_pos",
+    "ref",
+    "alt",
+    "filters",
+    "status",
+)
+
+# Read buffer for the genotype input.
+INPUT_BUFFER_SIZE = 1 << 20
+
+# Output files are written in large blocks rather than one syscall per ~8 KiB.
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+Query = Tuple[str, str, int]
+# ref_contig, ref_pos, ref, alt, filters of a matched reference record.
+RefFields = Tuple[str, str, str, str, str]
+Match = Tuple[Query, Optional[RefFields], str]
+# start, end, rs numbers (None: match via record_matches), record.
+Buffered = Tuple[int, int, Optional[Tuple[int, ...]], Variant]
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -79,6 +115,28 @@ def parse_args() -> argparse.Namespace:
         default=0,
         help="If non-zero, search ±window bp when exact position misses",
     )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=max(1, (os.cpu_count() or 1) // 2),
+        help="htslib threads for BGZF decompression, split among --jobs "
+        "workers (default: half the CPUs)",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Worker processes matching contigs in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=("auto", "fetch", "prescan"),
+        default="fetch",
+        help="fetch: tabix lookups around each query (default); prescan: one "
+        "sequential pass per contig; auto: prescan contigs whose queries are "
+        f"under {FETCH_MERGE_GAP:,} bp apart on average (needs contig lengths "
+        "in the VCF header)",
+    )
     return parser.parse_args()
 
 
@@ -86,24 +144,26 @@ def iter_genotype_rows(
     path: Path, limit: Optional[int]
 ) -> Iterator[Tuple[str, str, int]]:
     count = 0
-    with path.open() as handle:
+    with open(path, "rb", buffering=INPUT_BUFFER_SIZE) as handle:
         for raw in handle:
-            if raw.startswith("#"):
+            if raw.startswith(b"#"):
                 continue
-            parts = raw.strip().split("\t")
-            if len(parts) < 3:
+            rsid, _, rest = raw.partition(b"\t")
+            chrom, sep, rest = rest.partition(b"\t")
+            if not sep:
                 continue
-            rsid, chrom, pos = parts[0], parts[1], parts[2]
+            pos = rest.partition(b"\t")[0]
             try:
                 pos_int = int(pos)
             except ValueError:
                 continue
-            yield rsid, chrom, pos_int
+            yield rsid.decode(), chrom.decode(), pos_int
             count += 1
             if limit and count >= limit:
                 break
 
 
+@functools.lru_cache(maxsize=64)
 def normalize_chrom(value: str) -> Optional[str]:
     clean = value.strip().upper()
     if clean.startswith("CHR"):
@@ -111,74 +171,322 @@ def normalize_chrom(value: str) -> Optional[str]:
     return CONTIG_MAP.get(clean)
 
 
-def record_matches(rec: pysam.VariantRecord, target: str) -> bool:
+def record_ids(rec: Variant) -> List[str]:
     ids: List[str] = []
-    if rec.id and rec.id != ".":
-        ids.extend(part.strip() for part in rec.id.split(";") if part.strip())
-    rs_info = rec.info.get("RS")
+    if rec.ID:
+        ids.extend(part.strip() for part in rec.ID.split(";") if part.strip())
+    rs_info = rec.INFO.get("RS")
     if rs_info:
         if isinstance(rs_info, (list, tuple)):
             ids.extend(f"rs{int(v)}" for v in rs_info)
         else:
             ids.append(f"rs{int(rs_info)}")
-    return target in ids
+    return ids
 
 
-def fetch_variant(
-    vf: pysam.VariantFile, contig: str, pos: int, rsid: str, window: int
-) -> Tuple[Optional[pysam.VariantRecord], str]:
-    if contig not in vf.header.contigs:
-        return None, "missing_contig"
+def rs_number(rsid: str) -> Optional[int]:
+    """``rs123`` -> 123; None for ids that no RS INFO value can spell."""
+    digits = rsid[2:]
+    if rsid.startswith("rs") and digits.isdigit() and digits[0] != "0":
+        return int(digits)
+    return None
 
-    def search(start: int, end: int) -> Optional[pysam.VariantRecord]:
-        try:
-            for rec in vf.fetch(contig, max(0, start), end):
-                if record_matches(rec, rsid):
-                    return rec
-        except ValueError:
-            return None
+
+def record_matches(rec: Variant, target: str, target_rs: Optional[int]) -> bool:
+    # Nearly every dbSNP record carries exactly the rsid as its ID.
+    rid = rec.ID
+    if rid:
+        if rid == target:
+            return True
+        if ";" in rid and target in (part.strip() for part in rid.split(";")):
+            return True
+    if target_rs is None:
+        return False
+    rs_info = rec.INFO.get("RS")
+    if rs_info is None:
+        return False
+    if isinstance(rs_info, (list, tuple)):
+        return any(int(v) == target_rs for v in rs_info)
+    return int(rs_info) == target_rs
+
+
+def reference_fields(rec: Variant) -> RefFields:
+    return (
+        rec.CHROM,
+        str(rec.POS),
+        rec.REF or "",
+        ",".join(rec.ALT),
+        ";".join(rec.FILTERS),
+    )
+
+
+def record_rs_numbers(rec: Variant) -> Optional[Tuple[int, ...]]:
+    """ID and RS INFO numbers of a plain-rsid record (nearly all of dbSNP).
+
+    None for records with no or several IDs; those go through record_ids or
+    record_matches instead.
+    """
+    id_rs = rs_number(rec.ID) if rec.ID else None
+    if id_rs is None:
         return None
+    rs_info = rec.INFO.get("RS")
+    if rs_info is None:
+        return (id_rs,)
+    if isinstance(rs_info, (list, tuple)):
+        return (id_rs, *map(int, rs_info))
+    return (id_rs, int(rs_info))
+
+
+def buffer_record(rec: Variant) -> Buffered:
+    """Decode interval and rs numbers once, as the record enters the buffer.
+
+    Queries then match plain-rsid records with integer comparisons.
+    """
+    return rec.start, rec.end, record_rs_numbers(rec), rec
+
+
+def first_match(
+    pending: Iterable[Buffered],
+    start: int,
+    end: int,
+    rsid: str,
+    target_rs: Optional[int],
+) -> Optional[Variant]:
+    for rec_start, rec_end, keys, rec in pending:
+        if rec_start >= end or rec_end <= start:
+            continue
+        if keys is not None:
+            if target_rs in keys:
+                return rec
+        elif record_matches(rec, rsid, target_rs):
+            return rec
+    return None
+
 
-    rec = search(pos - 1, pos)
-    if rec:
-        return rec, "exact"
+def find_match(
+    pending: Iterable[Buffered], pos: int, rsid: str, window: int
+) -> Tuple[Optional[RefFields], str]:
+    target_rs = rs_number(rsid)
+    rec = first_match(pending, pos - 1, pos, rsid, target_rs)
+    if rec is not None:
+        return reference_fields(rec), "exact"
     if window > 0:
-        rec = search(pos - 1 - window, pos + window)
-        if rec:
-            return rec, "window"
+        start, end = max(0, pos - 1 - window), pos + window
+        rec = first_match(pending, start, end, rsid, target_rs)
+        if rec is not None:
+            return reference_fields(rec), "window"
     return None, "not_found"
 
 
+def iter_clusters(queries: List[Query], window: int) -> Iterator[List[Query]]:
+    cluster: List[Query] = []
+    cluster_end = 0
+    for query in queries:
+        pos = query[2]
+        if cluster and pos - 1 - window - cluster_end > FETCH_MERGE_GAP:
+            yield cluster
+            cluster = []
+        cluster.append(query)
+        cluster_end = pos + window
+    if cluster:
+        yield cluster
+
+
+def match_cluster(
+    vf: VCF, contig: str, cluster: List[Query], window: int
+) -> Iterator[Match]:
+    start = max(0, cluster[0][2] - 1 - window)
+    end = cluster[-1][2] + window
+    records = vf(f"{contig}:{start + 1}-{end}")
+
+    # Walk the records and the sorted queries together, keeping only the
+    # records that can still overlap the current query's search region.
+    pending: Deque[Buffered] = deque()
+    upcoming = next(records, None)
+    for query in cluster:
+        rsid, _, pos = query
+        search_start, search_end = max(0, pos - 1 - window), pos + window
+        while upcoming is not None and upcoming.start < search_end:
+            pending.append(buffer_record(upcoming))
+            upcoming = next(records, None)
+        while pending and pending[0][1] <= search_start:
+            pending.popleft()
+        ref, status = find_match(pending, pos, rsid, window)
+        yield query, ref, status
+
+
+def prescan_contig(
+    vf: VCF, contig: str, queries: List[Query], window: int
+) -> Iterator[Match]:
+    """Read the whole contig once, keeping records whose ids were queried."""
+    wanted = {rsid for rsid, _, _ in queries}
+    # Plain-rsid records are matched on their integer rs numbers, without
+    # building id strings for every record of the contig.
+    wanted_rs: Dict[int, str] = {}
+    for rsid in wanted:
+        target_rs = rs_number(rsid)
+        if target_rs is not None:
+            wanted_rs[target_rs] = rsid
+    hits: Dict[str, List[Tuple[int, int, RefFields]]] = {}
+    for rec in vf(contig):
+        keys = record_rs_numbers(rec)
+        if keys is not None:
+            # keys is usually (n, n): ID and RS INFO spell the same rsid, so
+            # the record is indexed once per queried rsid.
+            hit = None
+            for key in keys:
+                rsid = wanted_rs.get(key)
+                if rsid is None:
+                    continue
+                if hit is None:
+                    hit = (rec.start, rec.end, reference_fields(rec))
+                entries = hits.setdefault(rsid, [])
+                if not entries or entries[-1] is not hit:
+                    entries.append(hit)
+            continue
+        for rsid in dict.fromkeys(record_ids(rec)):
+            if rsid in wanted:
+                hits.setdefault(rsid, []).append(
+                    (rec.start, rec.end, reference_fields(rec))
+                )
+
+    for query in queries:
+        rsid, _, pos = query
+        candidates = hits.get(rsid, [])
+        ref, status = None, "not_found"
+        for start, end, fields in candidates:
+            if start < pos and end > pos - 1:
+                ref, status = fields, "exact"
+                break
+        else:
+            if window > 0:
+                search_start, search_end = max(0, pos - 1 - window), pos + window
+                for start, end, fields in candidates:
+                    if start < search_end and end > search_start:
+                        ref, status = fields, "window"
+                        break
+        yield query, ref, status
+
+
+def use_prescan(vf: VCF, contig: str, queries: List[Query], mode: str) -> bool:
+    if mode != "auto":
+        return mode == "prescan"
+    try:
+        length = vf.seqlens[vf.seqnames.index(contig)]
+    except AttributeError:
+        # No contig lengths in the header: the density is unknown.
+        return False
+    return len(queries) * FETCH_MERGE_GAP >= length
+
+
+def match_contig(
+    vf: VCF, contig: str, queries: List[Query], window: int, mode: str
+) -> Iterator[Match]:
+    if contig not in vf.seqnames:
+        for query in queries:
+            yield query, None, "missing_contig"
+        return
+    queries.sort(key=itemgetter(2))
+    if use_prescan(vf, contig, queries, mode):
+        yield from prescan_contig(vf, contig, queries, window)
+        return
+    for cluster in iter_clusters(queries, window):
+        yield from match_cluster(vf, contig, cluster, window)
+
+
+def match_contig_in_worker(
+    vcf_path: str,
+    threads: int,
+    contig: str,
+    queries: List[Query],
+    window: int,
+    mode: str,
+) -> List[Match]:
+    """Process pool entry point; VCF handles can't be shared, so open one here."""
+    vf = VCF(vcf_path, threads=threads)
+    try:
+        return list(match_contig(vf, contig, queries, window, mode))
+    finally:
+        vf.close()
+
+
+def lookup_rows(
+    vcf_path: Path,
+    rows: Iterable[Query],
+    *,
+    window: int,
+    mode: str,
+    threads: int,
+    jobs: int,
+) -> Iterator[Match]:
+    """Resolve rows contig by contig (in order of first appearance), position-sorted."""
+    by_contig: Dict[str, List[Query]] = {}
+    unmapped: List[Query] = []
+    for row in rows:
+        contig = normalize_chrom(row[1])
+        if contig:
+            by_contig.setdefault(contig, []).append(row)
+        else:
+            unmapped.append(row)
+    if jobs > 1:
+        # --threads is the total htslib budget, shared among the workers.
+        worker_threads = max(1, threads // jobs)
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [
+                pool.submit(
+                    match_contig_in_worker,
+                    str(vcf_path),
+                    worker_threads,
+                    contig,
+                    queries,
+                    window,
+                    mode,
+                )
+                for contig, queries in by_contig.items()
+            ]
+            for future in futures:
+                yield from future.result()
+    else:
+        vf = VCF(str(vcf_path), threads=threads)
+        try:
+            for contig, queries in by_contig.items():
+                yield from match_contig(vf, contig, queries, window, mode)
+        finally:
+            vf.close()
+    for row in unmapped:
+        yield row, None, "no_contig"
+
+
 def build_row(
-    query: Tuple[str, str, int],
-    rec: Optional[pysam.VariantRecord],
+    query: Query,
+    ref: Optional[RefFields],
     status: str,
-) -> Dict[str, str]:
+) -> Tuple[str, ...]:
+    """Output fields in OUTPUT_FIELDS order."""
     rsid, chrom, pos = query
-    output = {
-        "query_rsid": rsid,
-        "query_chrom": chrom,
-        "query_pos": str(pos),
-        "ref_contig": "",
-        "ref_pos": "",
-        "ref": "",
-        "alt": "",
-        "filters": "",
-        "status": status,
-    }
-    if rec:
-        output.update(
-            {
-                "ref_contig": rec.contig,
-                "ref_pos": str(rec.pos),
-                "ref": rec.ref or "",
-                "alt": ",".join(rec.alts or []),
-                "filters": ";".join(rec.filter.keys())
-                if rec.filter is not None
-                else "PASS",
-            }
-        )
-    return output
+    if ref is None:
+        return (rsid, chrom, str(pos), "", "", "", "", "", status)
+    return (rsid, chrom, str(pos), *ref, status)
+
+
+def quote_csv_field(value: str) -> str:
+    if "," in value or '"' in value or "\n" in value or "\r" in value:
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def format_csv_row(values: Tuple[str, ...]) -> str:
+    """Render a row exactly as csv.writer's default (excel) dialect would."""
+    line = ",".join(values)
+    # Fast path: no field adds a comma, quote or line break of its own.
+    if (
+        line.count(",") != len(values) - 1
+        or '"' in line
+        or "\n" in line
+        or "\r" in line
+    ):
+        line = ",".join(quote_csv_field(value) for value in values)
+    return line + "\r\n"
 
 
 def main() -> None:
@@ -189,46 +497,42 @@ def main() -> None:
     if not args.vcf.exists():
         raise SystemExit(f"Missing VCF file: {args.vcf}")
 
-    vf = pysam.VariantFile(args.vcf)
-    rows: Iterable[Tuple[str, str, int]] = iter_genotype_rows(args.input, args.limit)
+    rows: Iterable[Query] = iter_genotype_rows(args.input, args.limit)
 
     exact_path: Path = args.output
     missing_path: Path = args.missing_output
     exact_path.parent.mkdir(parents=True, exist_ok=True)
     missing_path.parent.mkdir(parents=True, exist_ok=True)
 
-    exact_writer = None
-    missing_writer = None
+    header = format_csv_row(OUTPUT_FIELDS)
     exact_count = 0
     missing_count = 0
 
     with (
-        exact_path.open("w", newline="") as exact_handle,
-        missing_path.open("w", newline="") as missing_handle,
+        exact_path.open("w", newline="", buffering=OUTPUT_BUFFER_SIZE) as exact_handle,
+        missing_path.open(
+            "w", newline="", buffering=OUTPUT_BUFFER_SIZE
+        ) as missing_handle,
     ):
-        for row in rows:
-            rsid, chrom, pos = row
-            contig = normalize_chrom(chrom)
-            rec = None
-            status = "no_contig"
-            if contig:
-                rec, status = fetch_variant(vf, contig, pos, rsid, args.window)
-            csv_row = build_row(row, rec, status)
+        matches = lookup_rows(
+            args.vcf,
+            rows,
+            window=args.window,
+            mode=args.mode,
+            threads=args.threads,
+            jobs=args.jobs,
+        )
+        for row, ref, status in matches:
+            line = format_csv_row(build_row(row, ref, status))
             if status == "exact":
-                if exact_writer is None:
-                    exact_writer = csv.DictWriter(
-                        exact_handle, fieldnames=list(csv_row.keys())
-                    )
-                    exact_writer.writeheader()
-                exact_writer.writerow(csv_row)
+                if exact_count == 0:
+                    exact_handle.write(header)
+                exact_handle.write(line)
                 exact_count += 1
             else:
-                if missing_writer is None:
-                    missing_writer = csv.DictWriter(
-                        missing_handle, fieldnames=list(csv_row.keys())
-                    )
-                    missing_writer.writeheader()
-                missing_writer.writerow(csv_row)
+                if missing_count == 0:
+                    missing_handle.write(header)
+                missing_handle.write(line)
                 missing_count += 1
 
     print(
@@ -0,0 +1,86 @@
+"""The in-memory and --sorted diffs must report the same result."""
+
+from pathlib import Path
+
+import pytest
+
+import diff_genotypes
+
+BASELINE = (
+    "# comment\tline\n"
+    "\n"
+    "i9\t1\t1\t--\n"
+    "rs1\t1\t100\tAA\n"
+    "rs10\t1\t0300\tAG\t0.5\t0.1\n"
+    "rs11\t1\tNA\tnull\n"
+    "rs2\t1\t5\t\n"
+    "rs3\t2\t7\n"
+    "rs4\t2\t8\tC#T\r\n"
+    "rs4\t2\t9\tCC\n"
+    "rs5\tX\t1.5\tTT\n"
+    "rs7\t1\t1\tAA\n"
+)
+
+CANDIDATE = (
+    "i8\t1\t1\tAA\n"
+    "rs1\t1\t100\tAA\n"
+    "rs10\t1\t300\tAG\n"
+    "rs11\t1\tNA\tnull\n"
+    "rs2\t1\t5\tGG\n"
+    "rs3\t2\t7\tAA\n"
+    "rs4\t2\t9\tCT\n"
+    "rs5\tX\t1\tTT\n"
+    "rs8 \t1\t1\tAA\n"
+)
+
+
+# Files without a single four-column row.
+COMMENTS_ONLY = "# header\n"
+SHORT_ROWS = "rs1\t1\t100\nrs2\t1\t5\n"
+
+
+def run_both(tmp_path: Path, capsys, base: str, cand: str, max_diffs: int):
+    baseline = tmp_path / "baseline.txt"
+    candidate = tmp_path / "candidate.txt"
+    baseline.write_bytes(base.encode())
+    candidate.write_bytes(cand.encode())
+
+    diff_genotypes.diff_loaded(baseline, candidate, max_diffs)
+    loaded = capsys.readouterr().out
+    diff_genotypes.diff_sorted(baseline, candidate, max_diffs)
+    streamed = capsys.readouterr().out
+    return loaded, streamed
+
+
+@pytest.mark.parametrize("max_diffs", [1, 20])
+def test_sorted_matches_loaded(tmp_path: Path, capsys, max_diffs: int) -> None:
+    loaded, streamed = run_both(tmp_path, capsys, BASELINE, CANDIDATE, max_diffs)
+
+    assert streamed == loaded
+    assert "Baseline rows: 7\n" in loaded
+    assert "Genotype/position differences: 3\n" in loaded
+
+
+@pytest.mark.parametrize("empty", [COMMENTS_ONLY, SHORT_ROWS, ""])
+def test_file_without_rows(tmp_path: Path, capsys, empty: str) -> None:
+    loaded, streamed = run_both(tmp_path, capsys, empty, CANDIDATE, 20)
+
+    assert streamed == loaded
+    assert "Baseline rows: 0\n" in loaded
+    assert "Candidate rows: 9\n" in loaded
+
+    loaded, streamed = run_both(tmp_path, capsys, BASELINE, empty, 20)
+
+    assert streamed == loaded
+    assert "Candidate rows: 0\n" in loaded
+
+
+def test_many_chromosomes(tmp_path: Path, capsys) -> None:
+    # More contig names (e.g. GRCh38 alt/unplaced) than fit a small code.
+    rows = sorted(f"rs{i}\tchrUn_{i}\t{i}\tAA\n" for i in range(1, 301))
+    base = "".join(rows)
+    cand = base.replace("\tchrUn_7\t7\tAA", "\tchrUn_7\t7\tAG")
+    loaded, streamed = run_both(tmp_path, capsys, base, cand, 20)
+
+    assert streamed == loaded
+    assert "Genotype/position differences: 1\n" in loaded
@@ -0,0 +1,171 @@
+"""Lookup modes must agree with a brute-force scan of the reference VCF."""
+
+import csv
+import io
+import random
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import pytest
+
+cyvcf2 = pytest.importorskip("cyvcf2")
+pysam = pytest.importorskip("pysam")
+
+import extract_reference_variants as erv  # noqa: E402
+
+# chrom as written in genotype files, reference contig, length, record count.
+CONTIGS = [
+    ("1", "NC_000001.11", 20_000, 400),  # dense: auto prescans
+    ("chr2", "NC_000002.12", 1_000_000, 40),  # sparse: auto fetches
+    ("X", "NC_000023.11", 5_000, 30),
+]
+
+# (contig, start, end, ids, fields) of every fixture record, in file order.
+Record = Tuple[str, int, int, frozenset, erv.RefFields]
+
+
+def random_record(rng: random.Random, contig: str, pos: int, n: int):
+    ref = rng.choice(["A", "C", "GT", "TAAC"])
+    alt = ",".join(rng.sample(["A", "G", "T", "CT"], rng.randint(1, 2)))
+    filters = rng.choice(["PASS", ".", "LowQ", "LowQ;q10"])
+    number = 1000 * n + pos
+    kind = rng.random()
+    if kind < 0.7:
+        rid, info = f"rs{number}", f"RS={number}"
+    elif kind < 0.8:
+        rid, info = f"rs{number};rs{number + 1}", f"RS={number}"
+    elif kind < 0.9:
+        rid, info = ".", f"RS={number}"
+    elif kind < 0.95:
+        rid, info = f"i{number}", "."
+    else:
+        rid, info = f"rs0{number}", "."
+    ids = {part for part in rid.split(";") if part != "."}
+    if info != ".":
+        ids.add(f"rs{number}")
+    line = f"{contig}\t{pos}\t{rid}\t{ref}\t{alt}\t.\t{filters}\t{info}\n"
+    fields = (contig, str(pos), ref, alt, "" if filters == "." else filters)
+    return line, (contig, pos - 1, pos - 1 + len(ref), frozenset(ids), fields)
+
+
+@pytest.fixture(scope="module")
+def reference(tmp_path_factory) -> Tuple[Path, List[Record]]:
+    rng = random.Random(7)
+    lines = [
+        "##fileformat=VCFv4.2\n",
+        '##FILTER=<ID=PASS,Description="All filters passed">\n',
+        '##FILTER=<ID=LowQ,Description="low">\n',
+        '##FILTER=<ID=q10,Description="q10">\n',
+        '##INFO=<ID=RS,Number=1,Type=Integer,Description="rs">\n',
+    ]
+    lines += [f"##contig=<ID={c},length={n}>\n" for _, c, n, _ in CONTIGS]
+    lines.append("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n")
+    records: List[Record] = []
+    for n, (_, contig, length, count) in enumerate(CONTIGS):
+        # Sorted positions with repeats, so records can share a position.
+        for pos in sorted(rng.randint(1, length) for _ in range(count)):
+            line, record = random_record(rng, contig, pos, n)
+            lines.append(line)
+            records.append(record)
+
+    directory = tmp_path_factory.mktemp("reference")
+    plain = directory / "ref.vcf"
+    plain.write_text("".join(lines))
+    vcf = directory / "ref.vcf.gz"
+    pysam.tabix_compress(str(plain), str(vcf))
+    pysam.tabix_index(str(vcf), preset="vcf")
+    return vcf, records
+
+
+def make_queries(records: List[Record]) -> List[erv.Query]:
+    rng = random.Random(11)
+    chroms = {contig: chrom for chrom, contig, _, _ in CONTIGS}
+    queries = set()
+    for contig, start, _, ids, _ in records:
+        chrom = chroms[contig]
+        for rsid in ids:
+            queries.add((rsid, chrom, start + 1))
+            # Offsets reaching just past either edge of a ±3 bp window.
+            queries.add((rsid, chrom, start + 1 + rng.randint(-5, 8)))
+        queries.add((f"rs{rng.randint(1, 10**6)}", chrom, start + 1))
+    queries.add(("rs1", "3", 100))  # contig absent from the VCF
+    queries.add(("rs2", "Un", 100))  # no reference contig
+    shuffled = sorted(queries)
+    rng.shuffle(shuffled)
+    return shuffled
+
+
+def brute_force(
+    records: List[Record], query: erv.Query, window: int
+) -> Tuple[Optional[erv.RefFields], str]:
+    rsid, chrom, pos = query
+    contig = erv.normalize_chrom(chrom)
+    if contig is None:
+        return None, "no_contig"
+    if contig not in {c for _, c, _, _ in CONTIGS}:
+        return None, "missing_contig"
+    hits = [r for r in records if r[0] == contig and rsid in r[3]]
+    for _, start, end, _, fields in hits:
+        if start < pos and end > pos - 1:
+            return fields, "exact"
+    if window > 0:
+        for _, start, end, _, fields in hits:
+            if start < pos + window and end > pos - 1 - window:
+                return fields, "window"
+    return None, "not_found"
+
+
+@pytest.mark.parametrize("window", [0, 3])
+def test_modes_match_brute_force(reference, window: int) -> None:
+    vcf, records = reference
+    queries = make_queries(records)
+    expected = {q: brute_force(records, q, window) for q in queries}
+    statuses = {"exact", "not_found", "missing_contig", "no_contig"}
+    if window:
+        statuses.add("window")
+    assert {status for _, status in expected.values()} >= statuses
+
+    results: Dict[Tuple[str, int], list] = {}
+    for mode in ("fetch", "prescan", "auto"):
+        for jobs in (1, 3):
+            matches = list(
+                erv.lookup_rows(
+                    vcf, queries, window=window, mode=mode, threads=2, jobs=jobs
+                )
+            )
+            assert len(matches) == len(queries)
+            assert {q: (ref, status) for q, ref, status in matches} == expected
+            results[mode, jobs] = matches
+
+    # Same rows in the same order, whatever the mode or worker count.
+    first = results["fetch", 1]
+    assert all(matches == first for matches in results.values())
+
+
+def test_auto_mode_follows_density(reference) -> None:
+    vcf, records = reference
+    by_contig: Dict[str, List[erv.Query]] = {}
+    for query in make_queries(records):
+        contig = erv.normalize_chrom(query[1])
+        by_contig.setdefault(contig, []).append(query)
+    vf = cyvcf2.VCF(str(vcf))
+    try:
+        assert erv.use_prescan(vf, "NC_000001.11", by_contig["NC_000001.11"], "auto")
+        assert not erv.use_prescan(
+            vf, "NC_000002.12", by_contig["NC_000002.12"], "auto"
+        )
+    finally:
+        vf.close()
+
+
+def test_format_csv_row_matches_csv_writer() -> None:
+    rng = random.Random(3)
+    alphabet = ["a", "1", " ", ",", '"', "\r", "\n", ";"]
+    for _ in range(20_000):
+        values = tuple(
+            "".join(rng.choices(alphabet, k=rng.randint(0, 4)))
+            for _ in erv.OUTPUT_FIELDS
+        )
+        expected = io.StringIO()
+        csv.writer(expected).writerow(values)
+        assert erv.format_csv_row(values) == expected.getvalue()
@@ -6,6 +6,10 @@ set -euo pipefail
 #   ./test.sh            # fast (default)
 #   ./test.sh --fast     # fast only
 #   ./test.sh --all      # same as --fast (placeholder for future suites)
+#
+# The fast suite also runs the pytest checks of scripts/ when pytest is
+# installed (jupyter.sh sets up pandas, pysam, cyvcf2 and pytest); on their
+# own: python3 -m pytest -q scripts
 
 MODE=${1:---fast}
 
@@ -20,6 +24,13 @@ cargo clippy --all-targets --all-features -q || true
 run_fast() {
   echo "==> Running fast tests"
   cargo test
+
+  echo "==> Running script tests"
+  if python3 -c "import pytest" 2>/dev/null; then
+    (cd .. && python3 -m pytest -q scripts)
+  else
+    echo "pytest not installed; skipping scripts/ tests (see jupyter.sh)"
+  fi
 }
 
 case "$MODE" in